@@ -1,91 +1,210 @@
+import logging
 import os
-import requests
-import pandas as pd
-from io import BytesIO
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from azure.storage.blob import BlobServiceClient
-import pyodbc
+
+from tlc_arrow import (
+    CSV_BATCH_ROWS,
+    csv_chunks,
+    staging_schema,
+    to_staging_table,
+    yellow_source_columns,
+)
+from tlc_common import (
+    BLOB_MAX_CONCURRENCY,
+    MIN_BYTES,
+    blob_container,
+    build_months,
+    download_to_file,
+    head_content_length,
+    load_format,
+    months_last_36,
+    setup_logging,
+    transfer_to_blob,
+)
+from tlc_sql import (
+    DELETE_MONTH_REFRESH_SQL,
+    LOG_DOWNLOAD_SQL,
+    MAX_WORKERS,
+    SqlSession,
+    load_month,
+    load_prepared_months,
+    log_etl,
+    processed_months,
+    with_sql_retry,
+)
+
+log = logging.getLogger(__name__)
 
 FORCE_REPROCESS = os.getenv("FORCE_REPROCESS", "false").lower() == "true"
 
+# csv     → parquet → CSV → Blob → BULK INSERT (works on any Azure SQL)
+# parquet → raw parquet → Blob → dbo.usp_stage_from_raw_yellow_parquet (no conversion)
+LOAD_FORMAT = load_format()
+
+# Also write the month as Hive-partitioned parquet (year=/month=) under
+# partitioned/yellow/ so downstream readers can prune by directory (csv mode only)
+WRITE_PARTITIONED = os.getenv("WRITE_PARTITIONED", "false").lower() == "true"
+
 # -------------------------------------------------
 # CONFIG
 # -------------------------------------------------
 CLOUDFRONT_BASE = "https://d37ci6vzurychx.cloudfront.net/trip-data"
 TAXI_TYPE = "yellow"
 
+PARTITIONED_PREFIX = "partitioned/yellow"
+PARTITIONING = pads.partitioning(
+    pa.schema([("year", pa.int16()), ("month", pa.int8())]),
+    flavor="hive",
+)
+
 
 # -------------------------------------------------
 # HELPERS
 # -------------------------------------------------
-def env(name: str) -> str:
-    val = os.getenv(name)
-    if not val:
-        raise RuntimeError(f"Missing environment variable: {name}")
-    return val
-
-
 def is_current_month(y: int, m: int) -> bool:
     today = datetime.today()
     return today.year == y and today.month == m
 
 
-def months_last_36():
-    start = datetime.today().replace(day=1) - relativedelta(months=35)
-    months = []
-    for i in range(36):
-        d = start + relativedelta(months=i)
-        months.append((d.year, d.month))
-    return months
-
-
-def build_months(start_year: int, start_month: int, count: int):
-    start = datetime(start_year, start_month, 1)
-    months = []
-    for i in range(count):
-        d = start + relativedelta(months=i)
-        months.append((d.year, d.month))
-    return months
-
-
-def sql_connect():
-    conn_str = (
-        "Driver={ODBC Driver 18 for SQL Server};"
-        f"Server=tcp:{env('SQL_SERVER')},1433;"
-        f"Database={env('SQL_DATABASE')};"
-        f"Uid={env('SQL_USERNAME')};"
-        f"Pwd={env('SQL_PASSWORD')};"
-        "Encrypt=yes;TrustServerCertificate=no;Connection Timeout=60;"
-    )
-    return pyodbc.connect(conn_str)
+def write_partitioned_month(pf: pq.ParquetFile, y: int, m: int, bc, workdir: str) -> int:
+    """
+    Write the month (staging columns + year/month) as Hive-partitioned parquet
+    and upload each part file. Partition values come from the file's month,
+    not pickup time, so every month lands in exactly one partition.
+    Returns the number of part files uploaded.
+    """
+    source_cols = yellow_source_columns(pf.schema_arrow)
+    read_cols = [c for c in source_cols if c]
+    schema = staging_schema(pf.schema_arrow).append(pa.field("year", pa.int16())).append(pa.field("month", pa.int8()))
+
+    def batches():
+        for batch in pf.iter_batches(batch_size=CSV_BATCH_ROWS, columns=read_cols):
+            table = to_staging_table(pa.Table.from_batches([batch]), source_cols)
+            n = table.num_rows
+            table = table.append_column("year", pa.array([y] * n, pa.int16()))
+            table = table.append_column("month", pa.array([m] * n, pa.int8()))
+            yield from table.to_batches()
+
+    out_dir = os.path.join(workdir, f"partitioned_{y}_{m:02d}")
+    try:
+        pads.write_dataset(
+            batches(),
+            out_dir,
+            schema=schema,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template="part-{i}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+        uploaded = 0
+        for root, _, files in os.walk(out_dir):
+            for name in files:
+                local_path = os.path.join(root, name)
+                rel_path = os.path.relpath(local_path, out_dir).replace(os.sep, "/")
+                with open(local_path, "rb") as f:
+                    bc.upload_blob(
+                        name=f"{PARTITIONED_PREFIX}/{rel_path}",
+                        data=f,
+                        length=os.path.getsize(local_path),
+                        overwrite=True,
+                        max_concurrency=BLOB_MAX_CONCURRENCY,
+                    )
+                uploaded += 1
+        return uploaded
+
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def prepare_month(y: int, m: int, bc, workdir: str):
+    """
+    Network/disk half of a month (runs in a worker thread, no SQL).
+    Returns ("skipped", message, None) or
+    ("ready", message, (load_blob_path, load_file_name, num_rows)).
+    """
+    parquet_name = f"yellow_tripdata_{y}-{m:02d}.parquet"
+    parquet_url = f"{CLOUDFRONT_BASE}/{parquet_name}"
+    parquet_path = os.path.join(workdir, parquet_name)
+    csv_name = f"yellow_tripdata_{y}-{m:02d}.csv"
+
+    try:
+        # Cheap preflight: missing or tiny months never start a download
+        size = head_content_length(parquet_url)
+        if size in (-403, -404):
+            return ("skipped", f"Parquet not available at source ({abs(size)})", None)
+        if 0 <= size < MIN_BYTES:
+            return ("skipped", "Empty or invalid parquet response", None)
+
+        # Download parquet (streamed to disk, or straight to Blob)
+        if LOAD_FORMAT == "parquet":
+            parquet_blob_path = f"parquet/yellow/year={y}/{parquet_name}"
+            # The HEAD above already ruled out a missing source
+            size = transfer_to_blob(parquet_url, parquet_blob_path, bc, preflight=False)
+        else:
+            size = download_to_file(parquet_url, parquet_path)
+
+        # 403/404 or missing file → SKIP (do not fail)
+        if size in (-403, -404):
+            return ("skipped", f"Parquet not available at source ({abs(size)})", None)
+
+        # Empty / invalid response
+        if size < MIN_BYTES:
+            return ("skipped", "Empty or invalid parquet response", None)
+
+        if LOAD_FORMAT == "parquet":
+            return ("ready", "Parquet in Blob → OPENROWSET (no CSV)", (parquet_blob_path, parquet_name, None))
 
+        try:
+            pf = pq.ParquetFile(parquet_path)
+        except Exception as e:
+            return ("skipped", f"Parquet parse error: {e}", None)
+
+        # Convert parquet → CSV while uploading to Blob
+        csv_blob_path = f"csv/yellow/year={y}/{csv_name}"
+        with pf:
+            bc.upload_blob(
+                name=csv_blob_path,
+                data=csv_chunks(pf),
+                overwrite=True,
+                max_concurrency=BLOB_MAX_CONCURRENCY,
+            )
 
-def blob_container():
-    service = BlobServiceClient(
-        account_url=env("STORAGE_ACCOUNT_URL"),
-        credential=env("STORAGE_ACCOUNT_KEY"),
-    )
-    return service.get_container_client(env("STORAGE_CONTAINER"))
+            if WRITE_PARTITIONED:
+                write_partitioned_month(pf, y, m, bc, workdir)
 
+        return ("ready", "Converted and uploaded CSV", (csv_blob_path, csv_name, pf.metadata.num_rows))
 
-def exists_in_download_log(cur, y: int, m: int) -> bool:
-    cur.execute("""
-        SELECT 1
-        FROM dbo.download_log
-        WHERE taxi_type = ?
-          AND [year] = ?
-          AND [month] = ?
-          AND status IN ('downloaded','loaded','completed')
-    """, (TAXI_TYPE, y, m))
-    return cur.fetchone() is not None
+    finally:
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
 
 
-def log_etl(cur, y, m, status, message):
-    cur.execute("""
-        INSERT INTO dbo.etl_run_log (taxi_type,[year],[month],status,message)
-        VALUES (?,?,?,?,?)
-    """, (TAXI_TYPE, y, m, status, message[:3900]))
+def log_and_load_month(sql: SqlSession, y: int, m: int, load_blob_path: str,
+                       load_file_name: str, num_rows: int = None):
+    """
+    SQL half of a month: log the download, then tlc_sql.load_month — both
+    in the one transaction load_month commits; the caller rolls back on error.
+    """
+    parquet_url = f"{CLOUDFRONT_BASE}/yellow_tripdata_{y}-{m:02d}.parquet"
+
+    sql.cur.execute(LOG_DOWNLOAD_SQL, (
+        TAXI_TYPE, y, m,
+        load_file_name,
+        parquet_url,
+        f"raw/{load_blob_path}",
+        "downloaded",
+        "GitHub Actions: parquet → Blob → SQL" if LOAD_FORMAT == "parquet"
+        else "GitHub Actions: parquet → CSV → Blob → SQL"
+    ))
+
+    load_month(sql, TAXI_TYPE, y, m, load_blob_path, num_rows, LOAD_FORMAT)
 
 
 # -------------------------------------------------
@@ -103,148 +222,67 @@ def main():
         months = months_last_36()
 
     bc = blob_container()
-    cn = sql_connect()
-    cur = cn.cursor()
+    sql = SqlSession()
+
+    log_rows = []
+    workdir = tempfile.mkdtemp(prefix="tlc_yellow_")
 
-    processed = 0
     skipped = 0
     failed = 0
 
+    # Decide what to run (SQL, main thread only)
+    done = processed_months(sql.cur, TAXI_TYPE)
+    todo = []
     for (y, m) in months:
-        print(f"\n=== Processing {y}-{m:02d} ===")
-
-        parquet_name = f"yellow_tripdata_{y}-{m:02d}.parquet"
-        parquet_url = f"{CLOUDFRONT_BASE}/{parquet_name}"
-        csv_blob_path = f"csv/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.csv"
-
         # Skip historical months already processed
-        if exists_in_download_log(cur, y, m) and not is_current_month(y, m) and not FORCE_REPROCESS:
+        if (y, m) in done and not is_current_month(y, m) and not FORCE_REPROCESS:
             skipped += 1
             continue
 
-
         try:
             # Refresh current month if needed
-            if exists_in_download_log(cur, y, m) and is_current_month(y, m):
-                cur.execute(
-                    "EXEC dbo.usp_delete_month_refresh @taxi_type=?, @year=?, @month=?",
-                    (TAXI_TYPE, y, m),
-                )
-                cn.commit()
-
-            # Download parquet
-            r = requests.get(parquet_url, timeout=240)
-
-            # 404 or missing file → SKIP (do not fail)
-            if r.status_code == 404:
-                print("SKIP: parquet not available (404)")
-                log_etl(cur, y, m, "skipped", "Parquet not available at source (404)")
-                cn.commit()
-                skipped += 1
-                continue
-
-            r.raise_for_status()
-
-            # Empty / invalid response
-            if not r.content or len(r.content) < 1024:
-                print("SKIP: empty or invalid parquet response")
-                log_etl(cur, y, m, "skipped", "Empty or invalid parquet response")
-                cn.commit()
-                skipped += 1
-                continue
-
-            # Convert parquet → CSV
-            try:
-                df = pd.read_parquet(BytesIO(r.content))
-            except Exception as e:
-                print(f"SKIP: parquet parse error: {e}")
-                log_etl(cur, y, m, "skipped", f"Parquet parse error: {e}")
-                cn.commit()
-                skipped += 1
-                continue
-
-            csv_bytes = df.to_csv(index=False).encode("utf-8")
-
-            # Upload CSV to Blob
-            bc.upload_blob(name=csv_blob_path, data=csv_bytes, overwrite=True)
-
-            # Log download
-            cur.execute("""
-                EXEC dbo.usp_log_download_start
-                    @taxi_type=?,
-                    @year=?,
-                    @month=?,
-                    @file_name=?,
-                    @file_url=?,
-                    @blob_path=?,
-                    @status=?,
-                    @message=?;
-            """, (
-                TAXI_TYPE, y, m,
-                f"yellow_tripdata_{y}-{m:02d}.csv",
-                parquet_url,
-                f"raw/{csv_blob_path}",
-                "downloaded",
-                "GitHub Actions: parquet → CSV → Blob → SQL"
-            ))
-            cn.commit()
-
-            # Load into SQL RAW via BULK INSERT
-            cur.execute("TRUNCATE TABLE dbo.stg_yellow_trip_raw;")
-            cn.commit()
-
-            bulk_sql = f"""
-            BULK INSERT dbo.stg_yellow_trip_raw
-            FROM '{csv_blob_path}'
-            WITH (
-                DATA_SOURCE = 'AzureBlobStorage',
-                FIRSTROW = 2,
-                FIELDTERMINATOR = ',',
-                ROWTERMINATOR = '0x0a',
-                TABLOCK,
-                CODEPAGE = '65001'
-            );
-            """
-            cur.execute(bulk_sql)
-            cn.commit()
-
-            # RAW → typed staging
-            cur.execute(
-                "EXEC dbo.usp_stage_from_raw_yellow @year=?, @month=?",
-                (y, m),
-            )
-            cn.commit()
+            if (y, m) in done and is_current_month(y, m):
+                def refresh():
+                    sql.cur.execute(DELETE_MONTH_REFRESH_SQL, (TAXI_TYPE, y, m))
+                    sql.cn.commit()
 
-            # typed staging → fact
-            cur.execute(
-                "EXEC dbo.usp_load_month_from_staging @taxi_type=?, @year=?, @month=?",
-                (TAXI_TYPE, y, m),
-            )
-            cn.commit()
+                with_sql_retry(refresh, sql.reset)
 
-            processed += 1
-            print("SUCCESS")
+            todo.append((y, m))
 
         except Exception as e:
             failed += 1
-            print(f"FAILED: {e}")
-            try:
-                log_etl(cur, y, m, "failed", str(e))
-                cn.commit()
-            except Exception:
-                pass
-
-    cur.close()
-    cn.close()
-
-    print(
+            log.info(f"FAILED {y}-{m:02d}: {e}")
+            sql.rollback()
+            log_etl(log_rows, TAXI_TYPE, y, m, "failed", str(e))
+
+    log.info(f"Months to process: {len(todo)} (workers={MAX_WORKERS})")
+
+    # Download/convert/upload in parallel, load into SQL one month at a time
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {
+            pool.submit(prepare_month, y, m, bc, workdir): (y, m, [f"\n=== Processing {y}-{m:02d} ==="])
+            for (y, m) in todo
+        }
+        processed, skipped_loads, failed_loads = load_prepared_months(
+            sql, futures, TAXI_TYPE, log_rows,
+            lambda y, m, payload: log_and_load_month(sql, y, m, *payload),
+        )
+        skipped += skipped_loads
+        failed += failed_loads
+
+    sql.close(log_rows)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    log.info(
         f"\nDONE → processed={processed}, skipped={skipped}, failed={failed}, total={len(months)}"
     )
 
     # Do NOT fail workflow just because some months were skipped
     if failed > 0:
-        print("Completed with some failures. Check etl_run_log.")
+        log.info("Completed with some failures. Check etl_run_log.")
 
 
 if __name__ == "__main__":
+    setup_logging()
     main()
@@ -1,9 +1,18 @@
-import requests
+import logging
 import os
-import time
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tlc_common import (
+    MIN_BYTES,
+    SERVER_SIDE_COPY,
+    blob_container,
+    existing_blobs,
+    month_range,
+    setup_logging,
+    transfer_to_blob,
+)
+
+log = logging.getLogger(__name__)
 
 # =================================================
 # CONFIG
@@ -14,137 +23,109 @@ TAXI_TYPE = "yellow"
 START_YEAR, START_MONTH = 2022, 10
 END_YEAR, END_MONTH     = 2025, 10
 
-# Azure Blob (container only, no prefix)
-STORAGE_ACCOUNT_URL = os.environ["STORAGE_ACCOUNT_URL"]
-STORAGE_CONTAINER   = os.environ["STORAGE_CONTAINER"]  # should be 'raw'
-STORAGE_ACCOUNT_KEY = os.environ["STORAGE_ACCOUNT_KEY"]
-
 # SAFETY SWITCH (DEFAULT = NO DELETE)
 DELETE_EXISTING = os.getenv("DELETE_EXISTING", "no").lower() == "yes"
 
-HEADERS = {
-    "User-Agent": (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/124.0.0.0 Safari/537.36"
-    ),
-    "Accept": "*/*",
-    "Accept-Encoding": "identity",
-}
-
-TIMEOUT = 120
-CHUNK_SIZE = 1024 * 1024
-RETRIES = 3
-MIN_BYTES = 1024
+# Months are independent (own URL, own blob): transfer them in parallel
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
 
 
 # =================================================
 # HELPERS
 # =================================================
-def month_range(start_year, start_month, end_year, end_month):
-    d = datetime(start_year, start_month, 1)
-    end = datetime(end_year, end_month, 1)
-    while d <= end:
-        yield d.year, d.month
-        d += relativedelta(months=1)
-
-
 def build_url(year, month):
     return f"{BASE_URL}/{TAXI_TYPE}_tripdata_{year}-{month:02d}.parquet"
 
 
-def container_client():
-    svc = BlobServiceClient(
-        account_url=STORAGE_ACCOUNT_URL,
-        credential=STORAGE_ACCOUNT_KEY,
-    )
-    return svc.get_container_client(STORAGE_CONTAINER)
+def process_month(y: int, m: int, container, existing: set):
+    """
+    One month: skip if present (unless DELETE_EXISTING), transfer. Runs in a
+    worker thread and only returns its outcome, so counters stay in main().
+    existing is the blob listing taken at startup (no exists() per month).
+    Returns (status, replaced, message) with status uploaded/skipped/failed.
+    """
+    url = build_url(y, m)
+
+    # ✅ CORRECT PATH (NO raw/raw)
+    blob_path = f"parquet/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.parquet"
 
+    replace = blob_path in existing
 
-def upload_stream_to_blob(url: str, blob_path: str, container):
-    blob = container.get_blob_client(blob_path)
+    # Skip if exists and not deleting
+    if replace and not DELETE_EXISTING:
+        return ("skipped", False, "already exists (safe mode)")
 
-    with requests.get(url, headers=HEADERS, stream=True, timeout=TIMEOUT) as r:
-        if r.status_code in (403, 404):
-            return -r.status_code
+    try:
+        # DELETE_EXISTING=yes: the transfer overwrites the blob in place — no
+        # separate delete round-trip. A streamed upload keeps the old file
+        # until it commits; a server-side copy replaces it as soon as it
+        # starts, and a failed month then removes the blob entirely
+        # Network retries happen inside the shared session (urllib3 Retry)
+        result = transfer_to_blob(url, blob_path, container)
 
-        r.raise_for_status()
+        if result in (-403, -404):
+            return ("skipped", False, f"HTTP {abs(result)}")
 
-        bytes_uploaded = 0
+        if result < MIN_BYTES:
+            raise RuntimeError(f"Invalid upload size ({result} bytes)")
 
-        def stream():
-            nonlocal bytes_uploaded
-            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    bytes_uploaded += len(chunk)
-                    yield chunk
+        existing.add(blob_path)
+        return ("uploaded", replace, f"{result} bytes → {blob_path}")
 
-        blob.upload_blob(stream(), overwrite=True)
-        return bytes_uploaded
+    except Exception as e:
+        return ("failed", False, str(e))
 
 
 # =================================================
 # MAIN
 # =================================================
 def main():
-    container = container_client()
-
-    uploaded = skipped = failed = deleted = 0
-
-    print(f"\nDELETE_EXISTING = {DELETE_EXISTING}\n")
+    container = blob_container()
 
-    for y, m in month_range(START_YEAR, START_MONTH, END_YEAR, END_MONTH):
-        url = build_url(y, m)
+    uploaded = skipped = failed = replaced = 0
 
-        # ✅ CORRECT PATH (NO raw/raw)
-        blob_path = f"parquet/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.parquet"
+    log.info("\n".join([
+        f"\nDELETE_EXISTING = {DELETE_EXISTING}",
+        f"SERVER_SIDE_COPY = {SERVER_SIDE_COPY}",
+        f"MAX_WORKERS = {MAX_WORKERS}\n",
+    ]))
 
-        print(f"=== {y}-{m:02d} ===")
-        print(f"URL : {url}")
-        print(f"BLOB: {blob_path}")
+    months = month_range(START_YEAR, START_MONTH, END_YEAR, END_MONTH)
+    existing = existing_blobs(container, "parquet/yellow/")
 
-        blob = container.get_blob_client(blob_path)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {pool.submit(process_month, y, m, container, existing): (y, m) for (y, m) in months}
 
-        try:
-            # Optional delete (ONLY if explicitly enabled)
-            if blob.exists() and DELETE_EXISTING:
-                blob.delete_blob()
-                deleted += 1
-                print("DELETED existing blob (DELETE_EXISTING=yes)")
+        for fut in as_completed(futures):
+            y, m = futures[fut]
+            status, was_replaced, message = fut.result()
 
-            # Skip if exists and not deleting
-            if blob.exists() and not DELETE_EXISTING:
-                print("SKIP → already exists (safe mode)")
-                skipped += 1
-                continue
-
-            for attempt in range(1, RETRIES + 1):
-                result = upload_stream_to_blob(url, blob_path, container)
-
-                if result in (-403, -404):
-                    print(f"SKIP → HTTP {abs(result)}")
-                    skipped += 1
-                    break
-
-                if result < MIN_BYTES:
-                    raise RuntimeError(f"Invalid upload size ({result} bytes)")
-
-                print(f"UPLOADED → {result} bytes")
+            if status == "uploaded":
                 uploaded += 1
-                break
-
-        except Exception as e:
-            print(f"FAILED → {e}")
-            failed += 1
-            time.sleep(3)
-
-    print("\n==============================")
-    print("FINISHED")
-    print(f"Uploaded: {uploaded}")
-    print(f"Deleted:  {deleted}")
-    print(f"Skipped:  {skipped}")
-    print(f"Failed:   {failed}")
-    print("==============================")
+                line = f"{y}-{m:02d} UPLOADED → {message}"
+            elif status == "skipped":
+                skipped += 1
+                line = f"{y}-{m:02d} SKIP → {message}"
+            else:
+                failed += 1
+                line = f"{y}-{m:02d} FAILED → {message}"
+
+            if was_replaced:
+                replaced += 1
+                line += " (replaced existing blob, DELETE_EXISTING=yes)"
+
+            log.info(line)
+
+    log.info("\n".join([
+        "\n==============================",
+        "FINISHED",
+        f"Uploaded: {uploaded}",
+        f"Replaced: {replaced}",
+        f"Skipped:  {skipped}",
+        f"Failed:   {failed}",
+        "==============================",
+    ]))
 
 if __name__ == "__main__":
+    setup_logging()
     main()
@@ -1,51 +1,88 @@
+import io
+import logging
 import os
-import tempfile
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-
-import pandas as pd
-import pyodbc
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tlc_arrow import csv_chunks
+from tlc_common import (
+    BLOB_MAX_CONCURRENCY,
+    blob_container,
+    existing_blobs,
+    load_format,
+    month_range,
+    setup_logging,
+)
+from tlc_sql import (
+    MAX_WORKERS,
+    SqlSession,
+    load_month,
+    load_prepared_months,
+    processed_months,
+)
+
+log = logging.getLogger(__name__)
 
 TAXI_TYPE = "yellow"
-EXTERNAL_DATA_SOURCE = "AzureBlobStorage"  # must match your SQL external data source name
-
-def env(name: str) -> str:
-    v = os.getenv(name)
-    if not v:
-        raise RuntimeError(f"Missing environment variable: {name}")
-    return v
-
-def month_range(start_y: int, start_m: int, end_y: int, end_m: int):
-    d = datetime(start_y, start_m, 1)
-    end = datetime(end_y, end_m, 1)
-    while d <= end:
-        yield d.year, d.month
-        d += relativedelta(months=1)
-
-def blob_container():
-    svc = BlobServiceClient(account_url=env("STORAGE_ACCOUNT_URL"), credential=env("STORAGE_ACCOUNT_KEY"))
-    return svc.get_container_client(env("STORAGE_CONTAINER"))  # should be 'raw'
-
-def sql_conn():
-    conn_str = (
-        "Driver={ODBC Driver 18 for SQL Server};"
-        f"Server=tcp:{env('SQL_SERVER')},1433;"
-        f"Database={env('SQL_DATABASE')};"
-        f"Uid={env('SQL_USERNAME')};"
-        f"Pwd={env('SQL_PASSWORD')};"
-        "Encrypt=yes;TrustServerCertificate=no;Connection Timeout=60;"
-    )
-    return pyodbc.connect(conn_str)
-
-def exists_in_download_log(cur, y: int, m: int) -> bool:
-    cur.execute("""
-        SELECT 1
-        FROM dbo.download_log
-        WHERE taxi_type=? AND [year]=? AND [month]=?
-          AND status IN ('downloaded','loaded','completed')
-    """, (TAXI_TYPE, y, m))
-    return cur.fetchone() is not None
+
+# csv     → parquet blob → CSV blob → BULK INSERT (works on any Azure SQL)
+# parquet → dbo.usp_stage_from_raw_yellow_parquet reads the parquet blob
+#           directly (OPENROWSET): no conversion, no CSV blob
+LOAD_FORMAT = load_format()
+
+def prepare_csv(container, existing: set, replaced: list, parquet_blob: str, csv_blob: str,
+                force_reprocess: bool, delete_existing_csv: bool):
+    """
+    Blob half of a month (runs in a worker thread, no SQL); holds the
+    month's parquet bytes plus ~one CSV batch.
+    existing is the blob listing taken at startup (no exists() per blob);
+    rebuilt CSVs that already existed are appended to replaced.
+    Returns ("skipped", message, None) or ("ready", message, (csv_blob, num_rows))
+    where num_rows is None when it is not known (reused CSV).
+    """
+    if parquet_blob not in existing:
+        return ("skipped", "parquet not found in Blob", None)
+
+    parquet_client = container.get_blob_client(parquet_blob)
+    csv_client = container.get_blob_client(csv_blob)
+
+    # ✅ Always rebuild CSV when forcing (or when DELETE_EXISTING_CSV asks for it).
+    # The upload overwrites it in place, so there is no separate delete call.
+    csv_exists = csv_blob in existing
+    if csv_exists and not (force_reprocess or delete_existing_csv):
+        return ("ready", "CSV exists → reuse", (csv_blob, None))
+
+    # Parquet blob → memory (parquet needs random access to its footer);
+    # CSV is produced batch by batch straight into the upload — no temp files.
+    # readinto() writes the parallel range GETs straight into one buffer that
+    # Arrow then reads in place (readall() would copy it into bytes first).
+    data = io.BytesIO()
+    parquet_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY).readinto(data)
+
+    with pq.ParquetFile(pa.BufferReader(pa.py_buffer(data.getbuffer()))) as pf:
+        num_rows = pf.metadata.num_rows
+        csv_client.upload_blob(
+            csv_chunks(pf),
+            overwrite=True,
+            max_concurrency=BLOB_MAX_CONCURRENCY,
+        )
+    existing.add(csv_blob)
+    if csv_exists:
+        replaced.append(csv_blob)
+
+    return ("ready", "Converted and uploaded CSV", (csv_blob, num_rows))
+
+def prepare_parquet(existing: set, parquet_blob: str):
+    """
+    LOAD_FORMAT=parquet: nothing to convert, only check the source is there.
+    Same return shape as prepare_csv.
+    """
+    if parquet_blob not in existing:
+        return ("skipped", "parquet not found in Blob", None)
+    return ("ready", "Parquet in Blob → OPENROWSET (no CSV)", (parquet_blob, None))
+
 
 def main():
     start_y = int(os.getenv("START_YEAR", "2022"))
@@ -57,115 +94,70 @@ def main():
     force_reprocess = os.getenv("FORCE_REPROCESS", "no").lower() == "yes"
     delete_existing_csv = os.getenv("DELETE_EXISTING_CSV", "no").lower() == "yes"
 
-    print(f"FORCE_REPROCESS = {force_reprocess}")
-    print(f"DELETE_EXISTING_CSV = {delete_existing_csv}")
-    print(f"Range: {start_y}-{start_m:02d} to {end_y}-{end_m:02d}")
+    log.info("\n".join([
+        f"LOAD_FORMAT = {LOAD_FORMAT}",
+        f"FORCE_REPROCESS = {force_reprocess}",
+        f"DELETE_EXISTING_CSV = {delete_existing_csv}",
+        f"Range: {start_y}-{start_m:02d} to {end_y}-{end_m:02d}",
+    ]))
 
     container = blob_container()
-    cn = sql_conn()
-    cur = cn.cursor()
+    sql = SqlSession()
 
-    processed = skipped = failed = csv_deleted = 0
+    skipped = 0
+    log_rows = []
+    replaced = []
 
+    # Decide what to run (SQL, main thread only): one download_log query
+    # for the whole range instead of one per month
+    done = processed_months(sql.cur, TAXI_TYPE)
+    todo = []
     for (y, m) in month_range(start_y, start_m, end_y, end_m):
-        parquet_blob = f"parquet/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.parquet"
-        csv_blob     = f"csv/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.csv"
-
-        print(f"\n=== {y}-{m:02d} ===")
-        print(f"Parquet: {parquet_blob}")
-        print(f"CSV:     {csv_blob}")
-
-        try:
-            parquet_client = container.get_blob_client(parquet_blob)
-            if not parquet_client.exists():
-                print("SKIP → parquet not found in Blob")
-                skipped += 1
-                continue
-
-            already = exists_in_download_log(cur, y, m)
-
-            # ✅ Only skip if NOT forcing
-            if already and not force_reprocess:
-                print("SKIP → already processed (historical)")
-                skipped += 1
-                continue
-
-            if already and force_reprocess:
-                print("FORCE REPROCESS → ignoring download_log status")
-
-            csv_client = container.get_blob_client(csv_blob)
-
-            # ✅ Always delete CSV when forcing, to rebuild cleanly
-            if force_reprocess and csv_client.exists():
-                csv_client.delete_blob()
-                csv_deleted += 1
-                print("FORCE REPROCESS → deleted existing CSV")
-
-            # Optional delete in non-force mode
-            if (not force_reprocess) and delete_existing_csv and csv_client.exists():
-                csv_client.delete_blob()
-                csv_deleted += 1
-                print("Deleted existing CSV (DELETE_EXISTING_CSV=yes)")
-
-            if not csv_client.exists():
-                # Download parquet to temp file
-                with tempfile.NamedTemporaryFile(suffix=".parquet", delete=False) as pf:
-                    parquet_path = pf.name
-                    pf.write(parquet_client.download_blob().readall())
-
-                # Convert to CSV temp file
-                with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as cf:
-                    csv_path = cf.name
-
-                df = pd.read_parquet(parquet_path)
-                df.to_csv(csv_path, index=False)
-
-                # Upload CSV to Blob
-                with open(csv_path, "rb") as f:
-                    csv_client.upload_blob(f, overwrite=True)
-
-                print("Converted and uploaded CSV")
+        already = (y, m) in done
+
+        # ✅ Only skip if NOT forcing
+        if already and not force_reprocess:
+            log.info(f"SKIP {y}-{m:02d} → already processed (historical)")
+            skipped += 1
+            continue
+
+        if already and force_reprocess:
+            log.info(f"FORCE REPROCESS {y}-{m:02d} → ignoring download_log status")
+
+        todo.append((y, m))
+
+    log.info(f"Months to process: {len(todo)} (workers={MAX_WORKERS})")
+
+    # One listing per prefix instead of exists() calls per month
+    existing = existing_blobs(container, "parquet/yellow/", "csv/yellow/")
+
+    # Build CSVs (or check parquet) in parallel, load into SQL one month at a time
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {}
+        for (y, m) in todo:
+            parquet_blob = f"parquet/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.parquet"
+            csv_blob     = f"csv/yellow/year={y}/yellow_tripdata_{y}-{m:02d}.csv"
+
+            # Header of the month's log record
+            lines = [f"\n=== {y}-{m:02d} ===", f"Parquet: {parquet_blob}"]
+            if LOAD_FORMAT == "parquet":
+                fut = pool.submit(prepare_parquet, existing, parquet_blob)
             else:
-                print("CSV exists → reuse")
-
-            # Load CSV → SQL RAW
-            cur.execute("TRUNCATE TABLE dbo.stg_yellow_trip_raw;")
-            cn.commit()
-
-            bulk_sql = f"""
-            BULK INSERT dbo.stg_yellow_trip_raw
-            FROM '{csv_blob}'
-            WITH (
-                DATA_SOURCE = '{EXTERNAL_DATA_SOURCE}',
-                FIRSTROW = 2,
-                FIELDTERMINATOR = ',',
-                ROWTERMINATOR = '0x0a',
-                TABLOCK,
-                CODEPAGE = '65001'
-            );
-            """
-            cur.execute(bulk_sql)
-            cn.commit()
-
-            # RAW → typed staging
-            cur.execute("EXEC dbo.usp_stage_from_raw_yellow @year=?, @month=?", (y, m))
-            cn.commit()
-
-            # typed staging → fact
-            cur.execute("EXEC dbo.usp_load_month_from_staging @taxi_type=?, @year=?, @month=?",
-                        (TAXI_TYPE, y, m))
-            cn.commit()
-
-            print("SUCCESS → month loaded into FACT")
-            processed += 1
-
-        except Exception as e:
-            print(f"FAILED → {e}")
-            failed += 1
-
-    cur.close()
-    cn.close()
-    print(f"\nDONE → processed={processed}, skipped={skipped}, failed={failed}, csv_deleted={csv_deleted}")
+                lines.append(f"CSV:     {csv_blob}")
+                fut = pool.submit(prepare_csv, container, existing, replaced, parquet_blob, csv_blob,
+                                  force_reprocess, delete_existing_csv)
+            futures[fut] = (y, m, lines)
+
+        def load(y, m, payload):
+            blob_path, num_rows = payload
+            load_month(sql, TAXI_TYPE, y, m, blob_path, num_rows, LOAD_FORMAT)
+
+        processed, skipped_loads, failed = load_prepared_months(sql, futures, TAXI_TYPE, log_rows, load)
+        skipped += skipped_loads
+
+    sql.close(log_rows)
+    log.info(f"\nDONE → processed={processed}, skipped={skipped}, failed={failed}, csv_replaced={len(replaced)}")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
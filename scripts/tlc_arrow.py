@@ -0,0 +1,106 @@
+"""
+Arrow helpers shared by the NYC TLC load scripts: parquet → staging columns
+→ CSV for BULK INSERT.
+
+Kept apart from tlc_common so the download-only script does not need
+pyarrow.
+"""
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# =================================================
+# CONFIG
+# =================================================
+# Column order of dbo.stg_yellow_trip_raw. Only these are read from parquet;
+# names match case-insensitively (airport_fee vs Airport_fee across years).
+YELLOW_COLS = [
+    "VendorID",
+    "tpep_pickup_datetime",
+    "tpep_dropoff_datetime",
+    "passenger_count",
+    "trip_distance",
+    "RatecodeID",
+    "store_and_fwd_flag",
+    "PULocationID",
+    "DOLocationID",
+    "payment_type",
+    "fare_amount",
+    "extra",
+    "mta_tax",
+    "tip_amount",
+    "tolls_amount",
+    "improvement_surcharge",
+    "total_amount",
+    "congestion_surcharge",
+    "airport_fee",
+]
+
+# CSV for BULK INSERT: no quoting (BULK INSERT keeps quote characters)
+# Only the first chunk of a streamed CSV carries the header
+CSV_WRITE_OPTIONS = pacsv.WriteOptions(quoting_style="none")
+CSV_WRITE_OPTIONS_NO_HEADER = pacsv.WriteOptions(include_header=False, quoting_style="none")
+# Rows per Arrow record batch when streaming parquet → CSV (bounds memory)
+CSV_BATCH_ROWS = 250_000
+
+
+# =================================================
+# HELPERS
+# =================================================
+def csv_schema(schema: pa.Schema) -> pa.Schema:
+    # Second precision keeps timestamps as "YYYY-MM-DD HH:MM:SS" (same as pandas)
+    return pa.schema([
+        pa.field(f.name, pa.timestamp("s")) if pa.types.is_timestamp(f.type) else f
+        for f in schema
+    ])
+
+
+def yellow_source_columns(schema: pa.Schema) -> list:
+    """
+    Parquet column name for each YELLOW_COLS entry (None where the file lacks it).
+    """
+    by_lower = {name.lower(): name for name in schema.names}
+    return [by_lower.get(c.lower()) for c in YELLOW_COLS]
+
+
+def staging_schema(schema: pa.Schema) -> pa.Schema:
+    """
+    Schema to_staging_table() produces for a parquet file with this schema.
+    """
+    source_cols = yellow_source_columns(schema)
+    empty = schema.empty_table().select([c for c in source_cols if c])
+    return to_staging_table(empty, source_cols).schema
+
+
+def to_staging_table(table: pa.Table, source_cols: list) -> pa.Table:
+    """
+    Reorder/rename to YELLOW_COLS (nulls for missing columns) and apply csv_schema.
+    """
+    arrays = [
+        table.column(src) if src else pa.nulls(table.num_rows)
+        for src in source_cols
+    ]
+    staged = pa.table(arrays, names=YELLOW_COLS)
+    return staged.cast(csv_schema(staged.schema), safe=False)
+
+
+def csv_chunks(pf: pq.ParquetFile):
+    """
+    Yield the month as CSV bytes, one record batch at a time, straight into
+    the Blob upload — peak memory is ~one batch and no CSV touches disk.
+    Only the staging columns (YELLOW_COLS) are decoded.
+    """
+    source_cols = yellow_source_columns(pf.schema_arrow)
+    read_cols = [c for c in source_cols if c]
+
+    first = True
+    for batch in pf.iter_batches(batch_size=CSV_BATCH_ROWS, columns=read_cols):
+        table = to_staging_table(pa.Table.from_batches([batch]), source_cols)
+        buf = pa.BufferOutputStream()
+        pacsv.write_csv(
+            table,
+            buf,
+            write_options=CSV_WRITE_OPTIONS if first else CSV_WRITE_OPTIONS_NO_HEADER,
+        )
+        first = False
+        yield buf.getvalue().to_pybytes()
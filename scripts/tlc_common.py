@@ -0,0 +1,351 @@
+"""
+Helpers shared by the NYC TLC ingestion scripts.
+
+Scripts are run as `python scripts/<name>.py`, so this module is importable
+as plain `import tlc_common`.
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+
+log = logging.getLogger(__name__)
+
+# =================================================
+# CONFIG
+# =================================================
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/124.0.0.0 Safari/537.36"
+    ),
+    "Accept": "*/*",
+}
+
+TIMEOUT = 120
+# Read size for download_to_file (HTTP body → local file)
+CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+RETRIES = 3
+# Anything smaller is an error page or the 0-byte placeholder a failed copy leaves
+MIN_BYTES = 1024
+
+# Let Azure Storage pull CloudFront files itself (Copy Blob from URL):
+# bytes never pass through the runner. If Storage cannot fetch the URL the
+# file is streamed through the runner instead. Disable: SERVER_SIDE_COPY=no
+SERVER_SIDE_COPY = os.getenv("SERVER_SIDE_COPY", "yes").lower() == "yes"
+COPY_POLL_SECONDS = 2
+COPY_TIMEOUT = 30 * 60
+
+# Azure Blob transport: urllib3 defaults to 10 pooled connections, which
+# parallel months × max_concurrency exhaust ("Connection pool is full").
+# Uploads stage up to BLOB_MAX_CONCURRENCY blocks in parallel per blob,
+# BLOB_BLOCK_SIZE each (SDK default is 4 MiB). Pool = 8 months × 8 blocks.
+BLOB_MAX_CONCURRENCY = 8
+BLOB_POOL_SIZE = 8 * BLOB_MAX_CONCURRENCY
+BLOB_BLOCK_SIZE = 8 * 1024 * 1024
+# Uploads of known length up to this size go as one Put Blob (no blocks,
+# no commit) — covers most monthly parquet files. Same as the SDK default.
+BLOB_MAX_SINGLE_PUT_SIZE = 64 * 1024 * 1024
+
+# One keep-alive session for all CloudFront requests (no TCP/TLS handshake
+# per month). Shared by worker threads; pool sized above MAX_WORKERS.
+# Connection errors and throttling/5xx are retried here by urllib3, so the
+# scripts need no retry loops of their own.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        # Exponential backoff (immediate, then 2s, 4s) plus up to 1s of jitter
+        # so parallel workers do not retry in lockstep; Retry-After on 429/503 wins
+        max_retries=Retry(
+            total=RETRIES,
+            backoff_factor=1,
+            backoff_jitter=1.0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
+
+# =================================================
+# HELPERS
+# =================================================
+def setup_logging():
+    """
+    Plain-message INFO logging to stdout for the scripts. Scripts log one
+    multi-line record per month rather than a print() per line.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+
+
+def env(name: str) -> str:
+    val = os.getenv(name)
+    if not val:
+        raise RuntimeError(f"Missing environment variable: {name}")
+    return val
+
+
+def load_format() -> str:
+    """
+    LOAD_FORMAT for the load scripts (default csv):
+      csv     → CSV in Blob → BULK INSERT (works on any Azure SQL)
+      parquet → parquet in Blob → OPENROWSET, no CSV step
+    """
+    fmt = (os.getenv("LOAD_FORMAT") or "csv").lower()
+    if fmt not in ("csv", "parquet"):
+        raise RuntimeError(f"Invalid LOAD_FORMAT: {fmt} (expected csv or parquet)")
+    return fmt
+
+
+# Months as plain integers (year * 12 + month - 1): no calendar objects
+def _month_index(year: int, month: int) -> int:
+    return year * 12 + (month - 1)
+
+
+def _year_month(index: int):
+    year, month0 = divmod(index, 12)
+    return year, month0 + 1
+
+
+def month_range(start_year: int, start_month: int, end_year: int, end_month: int):
+    start = _month_index(start_year, start_month)
+    end = _month_index(end_year, end_month)
+    return [_year_month(i) for i in range(start, end + 1)]
+
+
+def build_months(start_year: int, start_month: int, count: int):
+    start = _month_index(start_year, start_month)
+    return [_year_month(start + i) for i in range(count)]
+
+
+def months_last_36():
+    today = datetime.today()
+    return build_months(*_year_month(_month_index(today.year, today.month) - 35), 36)
+
+
+def blob_service_client(account_url: str, credential) -> BlobServiceClient:
+    """
+    BlobServiceClient on an explicit RequestsTransport whose session has a
+    connection pool sized for parallel transfers.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=BLOB_POOL_SIZE, pool_maxsize=BLOB_POOL_SIZE)
+    session.mount("https://", adapter)
+
+    # Connection settings belong to the transport once one is passed in
+    transport = RequestsTransport(
+        session=session,
+        connection_data_block_size=4 * 1024 * 1024,
+    )
+
+    return BlobServiceClient(
+        account_url=account_url,
+        credential=credential,
+        transport=transport,
+        max_block_size=BLOB_BLOCK_SIZE,
+        max_single_put_size=BLOB_MAX_SINGLE_PUT_SIZE,
+        max_single_get_size=64 * 1024 * 1024,
+    )
+
+
+def storage_credential():
+    """
+    STORAGE_ACCOUNT_KEY when set; otherwise Entra ID via DefaultAzureCredential
+    (managed identity, workload identity, az login). azure-identity is only
+    needed for the latter.
+    """
+    key = os.getenv("STORAGE_ACCOUNT_KEY")
+    if key:
+        return key
+
+    try:
+        from azure.identity import DefaultAzureCredential
+    except ImportError:
+        raise RuntimeError(
+            "Missing environment variable: STORAGE_ACCOUNT_KEY "
+            "(or pip install azure-identity to use DefaultAzureCredential)"
+        )
+    return DefaultAzureCredential()
+
+
+@lru_cache(maxsize=1)
+def blob_container():
+    """
+    Container client for the whole run: one service client, one transport
+    and one connection pool, however many times it is asked for.
+    """
+    service = blob_service_client(
+        account_url=env("STORAGE_ACCOUNT_URL"),
+        credential=storage_credential(),
+    )
+    return service.get_container_client(env("STORAGE_CONTAINER"))  # should be 'raw'
+
+
+def existing_blobs(container, *prefixes: str) -> set:
+    """
+    Names of all blobs under the given prefixes, from one paged listing per
+    prefix — replaces an exists() HEAD per blob per month. Blobs under
+    MIN_BYTES (left by a failed copy or upload) are not counted, so the
+    month is retried instead of skipped.
+    """
+    names = set()
+    for prefix in prefixes:
+        names.update(
+            b.name
+            for b in container.list_blobs(name_starts_with=prefix)
+            if b.size >= MIN_BYTES
+        )
+    return names
+
+
+def head_content_length(url: str) -> int:
+    """
+    HEAD the URL so missing/empty months are detected without a download.
+    Returns Content-Length, -1 if not sent, or -403/-404 if the source is missing.
+    """
+    r = SESSION.head(url, timeout=30, allow_redirects=True)
+    if r.status_code in (403, 404):
+        return -r.status_code
+
+    r.raise_for_status()
+    return int(r.headers.get("Content-Length", "-1"))
+
+
+def upload_stream_to_blob(url: str, blob_path: str, container) -> int:
+    """
+    Stream-download a URL and stream-upload directly to Azure Blob.
+    Files up to BLOB_MAX_SINGLE_PUT_SIZE go up in one request; larger ones
+    hold ~BLOB_MAX_CONCURRENCY blocks in memory regardless of file size.
+    Returns number of bytes uploaded, or -403/-404 if the source is missing.
+    """
+    blob = container.get_blob_client(blob_path)
+
+    with SESSION.get(url, stream=True, timeout=TIMEOUT, allow_redirects=True) as r:
+        if r.status_code in (403, 404):
+            return -r.status_code
+
+        r.raise_for_status()
+
+        # Known size lets the SDK pick a single Put Blob for small files.
+        # Content-Length is the on-wire size, so only trust it unencoded.
+        length = None
+        if not r.headers.get("Content-Encoding") and r.headers.get("Content-Length"):
+            length = int(r.headers["Content-Length"])
+
+        # Hand the socket's file object straight to the SDK (no Python
+        # generator, no per-chunk bytes); still decoded if ever compressed.
+        r.raw.decode_content = True
+
+        # Otherwise (larger or unknown size) the SDK reads max_block_size blocks
+        # off the stream and stages them (Put Block) on its own thread pool,
+        # at most BLOB_MAX_CONCURRENCY in flight, then commits the block list.
+        blob.upload_blob(
+            r.raw,
+            length=length,
+            overwrite=True,
+            max_concurrency=BLOB_MAX_CONCURRENCY,
+        )
+
+    # Size as stored, not as counted on the way through
+    return blob.get_blob_properties().size
+
+
+def copy_url_to_blob(url: str, blob_path: str, container, preflight: bool = True) -> int:
+    """
+    Server-side copy of a public URL into Azure Blob; waits for completion.
+    Returns blob size in bytes, or -403/-404 if the source is missing.
+    preflight=False skips the HEAD when the caller has already made it.
+    """
+    if preflight:
+        size = head_content_length(url)
+        if size in (-403, -404):
+            return size
+
+    blob = container.get_blob_client(blob_path)
+    blob.start_copy_from_url(url)
+
+    deadline = time.monotonic() + COPY_TIMEOUT
+    while True:
+        props = blob.get_blob_properties()
+        status = props.copy.status
+        if status != "pending":
+            break
+        if time.monotonic() > deadline:
+            blob.abort_copy(props.copy.id)
+            raise RuntimeError(f"Server-side copy timed out after {COPY_TIMEOUT}s")
+        time.sleep(COPY_POLL_SECONDS)
+
+    if status != "success":
+        raise RuntimeError(f"Server-side copy {status}: {props.copy.status_description}")
+
+    return props.size
+
+
+def transfer_to_blob(url: str, blob_path: str, container, preflight: bool = True) -> int:
+    """
+    Put a CloudFront file into Blob: server-side copy if SERVER_SIDE_COPY,
+    falling back to streaming it through this machine when the copy is
+    rejected or fails. Same return values as both; preflight is passed to
+    copy_url_to_blob.
+    """
+    if not SERVER_SIDE_COPY:
+        return upload_stream_to_blob(url, blob_path, container)
+
+    try:
+        return copy_url_to_blob(url, blob_path, container, preflight=preflight)
+    except (HttpResponseError, RuntimeError) as e:
+        log.warning(f"Server-side copy failed for {blob_path}, streaming instead: {e}")
+
+    try:
+        return upload_stream_to_blob(url, blob_path, container)
+    except Exception:
+        # A copy that started and then failed leaves a 0-byte blob in place of
+        # the old one; do not leave it behind for the next run to mistake for
+        # a finished month. A rejected copy wrote nothing: keep the old blob.
+        blob = container.get_blob_client(blob_path)
+        try:
+            props = blob.get_blob_properties()
+            if props.copy.status in ("failed", "aborted") or props.size < MIN_BYTES:
+                blob.delete_blob()
+        except HttpResponseError:
+            pass
+        raise
+
+
+def download_to_file(url: str, path: str) -> int:
+    """
+    Stream-download a URL to a local file (constant memory).
+    Returns number of bytes written, or -403/-404 if the source is missing.
+    """
+    with SESSION.get(url, stream=True, timeout=TIMEOUT, allow_redirects=True) as r:
+        if r.status_code in (403, 404):
+            return -r.status_code
+
+        r.raise_for_status()
+
+        written = 0
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+        return written
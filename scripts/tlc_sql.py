@@ -0,0 +1,244 @@
+"""
+Azure SQL helpers shared by the NYC TLC load scripts.
+
+Kept apart from tlc_common so the download-only script does not need
+pyodbc / the ODBC driver.
+"""
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+
+import pyodbc
+
+from tlc_common import env
+
+log = logging.getLogger(__name__)
+
+# ODBC driver-manager pooling (must be set before the first connect): a
+# reconnect after a dropped connection reuses a pooled one when it can.
+pyodbc.pooling = True
+
+# =================================================
+# CONFIG
+# =================================================
+# Statement text is fixed (values always bound as parameters), so every
+# month hits the same cached plan instead of compiling a new batch.
+LOG_DOWNLOAD_SQL = """
+    EXEC dbo.usp_log_download_start
+        @taxi_type=?,
+        @year=?,
+        @month=?,
+        @file_name=?,
+        @file_url=?,
+        @blob_path=?,
+        @status=?,
+        @message=?;
+"""
+DELETE_MONTH_REFRESH_SQL = "EXEC dbo.usp_delete_month_refresh @taxi_type=?, @year=?, @month=?"
+# CSV in Blob → RAW (BULK INSERT) → typed staging → fact in one round-trip
+# (sql/usp_load_month_end_to_end.sql)
+LOAD_MONTH_END_TO_END_SQL = """
+    EXEC dbo.usp_load_month_end_to_end
+        @taxi_type=?,
+        @year=?,
+        @month=?,
+        @csv_path=?,
+        @rows_per_batch=?;
+"""
+# parquet in Blob → RAW → typed staging (sql/usp_stage_from_raw_yellow_parquet.sql)
+STAGE_FROM_PARQUET_SQL = "EXEC dbo.usp_stage_from_raw_yellow_parquet @year=?, @month=?"
+LOAD_FROM_STAGING_SQL = "EXEC dbo.usp_load_month_from_staging @taxi_type=?, @year=?, @month=?"
+ETL_LOG_SQL = """
+    INSERT INTO dbo.etl_run_log (taxi_type,[year],[month],status,message)
+    VALUES (?,?,?,?,?)
+"""
+
+# Azure SQL transient errors worth retrying (reconfiguration, throttling,
+# resource limits). Connection-level failures surface as OperationalError.
+TRANSIENT_SQL_ERRORS = ("40197", "40501", "10928", "10929")
+SQL_RETRIES = 5
+SQL_RETRY_BASE_SECONDS = 2
+SQL_RETRY_MAX_SECONDS = 30
+
+# The loaders prepare months (download/convert/upload) in parallel; SQL loads
+# stay serial because every month goes through the same dbo.stg_yellow_trip_raw
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+
+
+# =================================================
+# HELPERS
+# =================================================
+def is_transient_sql_error(e: Exception) -> bool:
+    if isinstance(e, pyodbc.OperationalError):
+        return True
+    if not isinstance(e, pyodbc.Error):
+        return False
+    message = " ".join(str(a) for a in e.args)
+    return any(f"({code})" in message for code in TRANSIENT_SQL_ERRORS)
+
+
+def with_sql_retry(work, reset=None):
+    """
+    Run work(); on a transient Azure SQL error call reset() (rollback /
+    reconnect) and run it again, backing off 2, 4, 8, 16s (capped at 30s).
+    work must be safe to repeat — e.g. one month in one transaction.
+    """
+    for attempt in range(1, SQL_RETRIES + 1):
+        try:
+            return work()
+        except pyodbc.Error as e:
+            if attempt == SQL_RETRIES or not is_transient_sql_error(e):
+                raise
+            delay = min(SQL_RETRY_BASE_SECONDS * 2 ** (attempt - 1), SQL_RETRY_MAX_SECONDS)
+            log.warning(f"Transient SQL error (attempt {attempt}/{SQL_RETRIES}), retrying in {delay}s: {e}")
+            time.sleep(delay)
+            if reset:
+                reset()
+
+
+def sql_connect():
+    conn_str = (
+        "Driver={ODBC Driver 18 for SQL Server};"
+        f"Server=tcp:{env('SQL_SERVER')},1433;"
+        f"Database={env('SQL_DATABASE')};"
+        f"Uid={env('SQL_USERNAME')};"
+        f"Pwd={env('SQL_PASSWORD')};"
+        "Encrypt=yes;TrustServerCertificate=no;Connection Timeout=60;"
+    )
+    # Explicit transactions: the scripts COMMIT once per month
+    return with_sql_retry(lambda: pyodbc.connect(conn_str, autocommit=False))
+
+
+class SqlSession:
+    """
+    The connection and fast_executemany cursor a load script works through.
+    Pass .reset to with_sql_retry: a transient error may have dropped the
+    connection, so it is replaced rather than reused. Read .cn / .cur at
+    call time (inside the retried work), not once up front.
+    """
+
+    def __init__(self):
+        self.cn = None
+        self.cur = None
+        self.reset()
+
+    def reset(self):
+        if self.cn is not None:
+            try:
+                self.cn.close()
+            except Exception:
+                pass
+        self.cn = sql_connect()
+        self.cur = self.cn.cursor()
+        self.cur.fast_executemany = True
+
+    def rollback(self):
+        # After a failed month, so it never rides along into the next COMMIT
+        try:
+            self.cn.rollback()
+        except Exception:
+            pass
+
+    def close(self, log_rows: list = None):
+        # Best effort: a lost etl_run_log must not fail the run
+        if log_rows:
+            try:
+                flush_etl_log(self.cur, self.cn, log_rows)
+            except Exception as e:
+                log.warning(f"WARNING: could not write etl_run_log: {e}")
+        self.cur.close()
+        self.cn.close()
+
+
+def log_etl(log_rows: list, taxi_type: str, y: int, m: int, status: str, message: str):
+    # Buffered; written by flush_etl_log in one batch
+    log_rows.append((taxi_type, y, m, status, message[:3900]))
+
+
+def flush_etl_log(cur, cn, log_rows: list):
+    """
+    Write buffered (taxi_type, year, month, status, message) rows to
+    dbo.etl_run_log in one executemany (fast_executemany on the cursor).
+    """
+    if not log_rows:
+        return
+    cur.executemany(ETL_LOG_SQL, log_rows)
+    cn.commit()
+    log_rows.clear()
+
+
+def processed_months(cur, taxi_type: str) -> set:
+    """
+    All (year, month) already in dbo.download_log — one query per run
+    instead of one round-trip per month.
+    """
+    cur.execute("""
+        SELECT [year], [month]
+        FROM dbo.download_log
+        WHERE taxi_type = ?
+          AND status IN ('downloaded','loaded','completed')
+    """, (taxi_type,))
+    return {(int(r[0]), int(r[1])) for r in cur.fetchall()}
+
+
+def load_month(sql: SqlSession, taxi_type: str, y: int, m: int, blob_path: str,
+               num_rows: int, load_format: str):
+    """
+    Blob → RAW → typed staging → fact, then COMMIT: one transaction per month,
+    including anything the caller executed on sql.cur just before. Starts
+    with TRUNCATE (inside the procs), so it is safe to run again after a
+    transient failure; the caller rolls back on error.
+    """
+    if load_format == "parquet":
+        # parquet blob (OPENROWSET) → RAW → typed staging, server-side
+        sql.cur.execute(STAGE_FROM_PARQUET_SQL, (y, m))
+
+        # typed staging → fact
+        sql.cur.execute(LOAD_FROM_STAGING_SQL, (taxi_type, y, m))
+    else:
+        # BULK INSERT → RAW → typed staging → fact, one EXEC
+        sql.cur.execute(LOAD_MONTH_END_TO_END_SQL, (taxi_type, y, m, blob_path, num_rows))
+
+    sql.cn.commit()
+
+
+def load_prepared_months(sql: SqlSession, futures: dict, taxi_type: str, log_rows: list, load):
+    """
+    Load months into SQL one at a time, in the order their prepare futures
+    finish. futures maps each future to (y, m, header lines); a future
+    returns ("skipped", message, None) or ("ready", message, payload), and
+    load(y, m, payload) runs the month's transaction under with_sql_retry.
+    Logs one record per month and buffers skips/failures for etl_run_log.
+    Returns (processed, skipped, failed).
+    """
+    processed = skipped = failed = 0
+    for fut in as_completed(futures):
+        y, m, lines = futures[fut]
+        try:
+            status, message, payload = fut.result()
+
+            if status == "skipped":
+                lines.append(f"SKIP → {message}")
+                log_etl(log_rows, taxi_type, y, m, "skipped", message)
+                skipped += 1
+                continue
+
+            if message:
+                lines.append(message)
+
+            with_sql_retry(lambda: load(y, m, payload), sql.reset)
+
+            lines.append("SUCCESS → month loaded into FACT")
+            processed += 1
+
+        except Exception as e:
+            lines.append(f"FAILED → {e}")
+            failed += 1
+            sql.rollback()
+            log_etl(log_rows, taxi_type, y, m, "failed", str(e))
+
+        finally:
+            log.info("\n".join(lines))
+
+    return processed, skipped, failed
@@ -0,0 +1,66 @@
+/*
+    CSV (Blob) → dbo.stg_yellow_trip_raw → typed staging → fact, in one call.
+
+    Used by scripts/backfill_tlc_yellow.py and scripts/parquet_to_csv_and_load_sql.py
+    when LOAD_FORMAT=csv: replaces the separate TRUNCATE / BULK INSERT / EXEC
+    round-trips per month with a single EXEC.
+
+    Runs in the caller's transaction (the scripts connect with autocommit off
+    and COMMIT once per month); XACT_ABORT makes any error roll back the
+    whole month.
+
+    BULK INSERT only accepts the file path and hints as literals, so it is
+    built dynamically; the path is quoted by doubling its single quotes
+    (QUOTENAME returns NULL past 128 characters, which paths can exceed).
+
+    Requires:
+      - external data source AzureBlobStorage pointing at the 'raw' container
+      - dbo.usp_stage_from_raw_yellow, dbo.usp_load_month_from_staging
+*/
+CREATE OR ALTER PROCEDURE dbo.usp_load_month_end_to_end
+    @taxi_type      NVARCHAR(20),
+    @year           INT,
+    @month          INT,
+    @csv_path       NVARCHAR(400),
+    @rows_per_batch INT = NULL      -- row count of the file, when known
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    TRUNCATE TABLE dbo.stg_yellow_trip_raw;
+
+    -- Same options as the former client-side BULK INSERT
+    DECLARE @sql NVARCHAR(MAX) = N'
+        BULK INSERT dbo.stg_yellow_trip_raw
+        FROM ''' + REPLACE(@csv_path, N'''', N'''''') + N'''
+        WITH (
+            DATA_SOURCE = ''AzureBlobStorage'',
+            FIRSTROW = 2,
+            FIELDTERMINATOR = '','',
+            ROWTERMINATOR = ''0x0a'',
+            TABLOCK,
+            CODEPAGE = ''65001'',
+            BATCHSIZE = 100000'
+        + CASE
+            WHEN @rows_per_batch > 0
+                THEN N',
+            ROWS_PER_BATCH = ' + CAST(@rows_per_batch AS NVARCHAR(20))
+            ELSE N''
+          END
+        + N'
+        );';
+
+    -- NULL in any piece (e.g. @csv_path) would make EXEC a silent no-op
+    IF @sql IS NULL
+        THROW 50000, N'usp_load_month_end_to_end: @csv_path is NULL', 1;
+
+    EXEC sys.sp_executesql @sql;
+
+    -- RAW → typed staging
+    EXEC dbo.usp_stage_from_raw_yellow @year = @year, @month = @month;
+
+    -- typed staging → fact
+    EXEC dbo.usp_load_month_from_staging @taxi_type = @taxi_type, @year = @year, @month = @month;
+END;
+GO
@@ -0,0 +1,77 @@
+/*
+    RAW parquet (Blob) → dbo.stg_yellow_trip_raw → typed staging, in one call.
+
+    Used by scripts/backfill_tlc_yellow.py and scripts/parquet_to_csv_and_load_sql.py
+    when LOAD_FORMAT=parquet: the month's parquet is uploaded to Blob untouched
+    and read here with OPENROWSET(FORMAT = 'PARQUET'), so no CSV is ever produced.
+
+    OPENROWSET is used per month instead of one external table over
+    parquet/yellow/ because an external table cannot be filtered to a single
+    file — every load would scan all months.
+
+    Requires:
+      - external data source AzureBlobStorage (same one BULK INSERT uses),
+        pointing at the 'raw' container
+      - parquet support in OPENROWSET (SQL Server 2022 / Azure SQL)
+
+    RAW is the text table the CSV path bulk-loads, so every typed parquet
+    value is converted explicitly to the text that CSV carries: datetimes as
+    "YYYY-MM-DD HH:MM:SS" (style 120), counts/ids as integers, amounts through
+    DECIMAL(18,2). Implicit float → varchar keeps only 6 significant digits
+    (10000.05 → "10000") and datetime2 → varchar adds 7 fractional digits.
+
+    Runs in the caller's transaction; XACT_ABORT makes any error roll back
+    the whole month instead of staging a partly filled RAW table.
+*/
+CREATE OR ALTER PROCEDURE dbo.usp_stage_from_raw_yellow_parquet
+    @year  INT,
+    @month INT
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @path NVARCHAR(400) =
+        N'parquet/yellow/year=' + CAST(@year AS NVARCHAR(4))
+        + N'/yellow_tripdata_' + CAST(@year AS NVARCHAR(4))
+        + N'-' + RIGHT(N'0' + CAST(@month AS NVARCHAR(2)), 2)
+        + N'.parquet';
+
+    TRUNCATE TABLE dbo.stg_yellow_trip_raw;
+
+    -- Same 19 columns, same order as tlc_arrow.YELLOW_COLS.
+    -- Column names resolve case-insensitively (airport_fee / Airport_fee).
+    DECLARE @sql NVARCHAR(MAX) = N'
+        INSERT INTO dbo.stg_yellow_trip_raw WITH (TABLOCK)
+        SELECT
+            CONVERT(VARCHAR(20), CAST(r.VendorID AS BIGINT)),
+            CONVERT(VARCHAR(19), r.tpep_pickup_datetime, 120),
+            CONVERT(VARCHAR(19), r.tpep_dropoff_datetime, 120),
+            CONVERT(VARCHAR(20), CAST(r.passenger_count AS BIGINT)),
+            CONVERT(VARCHAR(20), CAST(r.trip_distance AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.RatecodeID AS BIGINT)),
+            CONVERT(VARCHAR(1), r.store_and_fwd_flag),
+            CONVERT(VARCHAR(20), CAST(r.PULocationID AS BIGINT)),
+            CONVERT(VARCHAR(20), CAST(r.DOLocationID AS BIGINT)),
+            CONVERT(VARCHAR(20), CAST(r.payment_type AS BIGINT)),
+            CONVERT(VARCHAR(20), CAST(r.fare_amount AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.extra AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.mta_tax AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.tip_amount AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.tolls_amount AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.improvement_surcharge AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.total_amount AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.congestion_surcharge AS DECIMAL(18,2))),
+            CONVERT(VARCHAR(20), CAST(r.airport_fee AS DECIMAL(18,2)))
+        FROM OPENROWSET(
+            BULK ''' + REPLACE(@path, N'''', N'''''') + N''',
+            DATA_SOURCE = ''AzureBlobStorage'',
+            FORMAT = ''PARQUET''
+        ) AS r;';
+
+    EXEC sys.sp_executesql @sql;
+
+    -- RAW → typed staging (unchanged)
+    EXEC dbo.usp_stage_from_raw_yellow @year = @year, @month = @month;
+END;
+GO